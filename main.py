@@ -3,21 +3,158 @@
 Анализ корреляции между средней позицией товара и количеством заказов
 """
 
+import os
+import hashlib
 import sqlite3
+from datetime import datetime, timedelta
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from scipy import stats
 import warnings
 warnings.filterwarnings('ignore')
 
+# Пакетный режим (HEADLESS=1): графики только сохраняются в файлы, без GUI
+HEADLESS = bool(os.environ.get('HEADLESS'))
+
+# Оформление графиков (фон и сетка в духе стиля seaborn)
+PLOT_STYLE = {
+    'figure.facecolor': 'white',
+    'axes.facecolor': '#EAEAF2',
+    'axes.edgecolor': 'white',
+    'axes.grid': True,
+    'axes.axisbelow': True,
+    'grid.color': 'white',
+    'grid.alpha': 0.3,
+}
+
+# Copy-on-Write: фильтры возвращают ленивые представления без копирования данных
+# (в pandas >= 3.0 включен всегда, опция устарела)
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
+
 
 
 # Статические даты для примера
 START_DATE = "2026-01-01"
 END_DATE = "2026-02-01"
 
+# Колонки таблицы, которые используются в анализе
+DATA_COLUMNS = ['avg_pos', 'orders', 'norm_query', 'advert_id', 'nm_id', 'date']
+OPTIONAL_COLUMNS = ['views', 'clicks', 'cpc', 'atbs']
+
+# Типы колонок при загрузке; остальные колонки (текст, даты) хранятся как object.
+# REAL и INTEGER в SQLite 64-битные, поэтому значения загружаются без потерь
+COLUMN_DTYPES = {
+    'avg_pos': np.float64,
+    'orders': np.int64,
+    'views': np.int64,
+    'clicks': np.int64,
+    'cpc': np.float64,
+    'atbs': np.int64,
+    'advert_id': np.int64,
+    'nm_id': np.int64,
+}
+FETCH_CHUNK_SIZE = 65_536
+
+# Каталог для кэша результатов запроса (Parquet). Версию формата нужно увеличивать
+# при изменении обработки данных в get_advertising_data
+CACHE_DIR = 'cache'
+CACHE_VERSION = 2
+
+# Больше этого числа записей лист "Данные" сохраняется в CSV, а не в Excel
+EXCEL_MAX_DATA_ROWS = 200_000
+
+# Группы позиций: интервалы [левая граница, правая граница)
+POSITION_BINS = np.array([0, 10, 20, 30, 50, 100, 200], dtype=np.float64)
+POSITION_LABELS = ['Топ-10', '11-20', '21-30', '31-50', '51-100', '100+']
+
+# Границы силы корреляции (по модулю) и соответствующие описания
+CORR_THRESHOLDS = np.array([0.1, 0.3, 0.7])
+CORR_LABELS = ('очень слабая или отсутствует', 'слабая', 'умеренная', 'сильная')
+
+def ensure_date_index(conn, ad_table):
+    """
+    Создание индекса по дате, чтобы фильтр периода не сканировал всю таблицу
+    """
+    try:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{ad_table}_date ON {ad_table}(date)")
+        conn.commit()
+    except sqlite3.Error as e:
+        # База может быть открыта только для чтения - работаем без индекса
+        print(f"Не удалось создать индекс по дате: {e}")
+
+def fetch_columns(conn, query, params, n_rows):
+    """
+    Чтение результата запроса пачками в заранее выделенные массивы по колонкам
+    """
+    cursor = conn.execute(query, params)
+    names = [col[0] for col in cursor.description]
+    buffers = {name: np.empty(n_rows, dtype=COLUMN_DTYPES.get(name, object)) for name in names}
+    
+    offset = 0
+    while offset < n_rows:
+        rows = cursor.fetchmany(min(FETCH_CHUNK_SIZE, n_rows - offset))
+        if not rows:
+            break
+        end = offset + len(rows)
+        for name, values in zip(names, zip(*rows)):
+            if buffers[name].dtype.kind == 'i' and any(isinstance(v, float) for v in values):
+                # REAL в целочисленной колонке: присваивание молча отбросило бы дробную часть
+                buffers[name] = buffers[name].astype(np.float64)
+            try:
+                buffers[name][offset:end] = values
+            except (TypeError, ValueError, OverflowError):
+                # NULL в целочисленной колонке - переходим на float64 (NaN),
+                # нечисловые значения - на object, как это делает pandas
+                fallback = np.float64 if buffers[name].dtype.kind == 'i' else object
+                try:
+                    buffers[name] = buffers[name].astype(fallback)
+                    buffers[name][offset:end] = values
+                except (TypeError, ValueError):
+                    buffers[name] = buffers[name].astype(object)
+                    buffers[name][offset:end] = values
+        offset = end
+    cursor.close()
+    
+    return pd.DataFrame({name: buf[:offset] for name, buf in buffers.items()}, copy=False)
+
+def get_cache_path(db_name, ad_table, start_date, end_date):
+    """
+    Путь к файлу кэша; ключ меняется при любом изменении базы данных
+    """
+    mtimes = [os.path.getmtime(path) for path in (db_name, db_name + '-wal') if os.path.exists(path)]
+    # Состав колонок и их типы тоже входят в ключ, чтобы старый кэш не подхватывался после их изменения
+    schema = (CACHE_VERSION, DATA_COLUMNS, OPTIONAL_COLUMNS,
+              sorted((col, np.dtype(dtype).name) for col, dtype in COLUMN_DTYPES.items()))
+    # Имя файла: <запрос>_<версия данных>. По первой части находятся устаревшие
+    # файлы того же запроса, которые удаляются при записи нового
+    scope = f"{os.path.abspath(db_name)}|{ad_table}|{start_date}|{end_date}"
+    version = f"{mtimes}|{schema}"
+    scope_key = hashlib.sha1(scope.encode()).hexdigest()[:16]
+    version_key = hashlib.sha1(version.encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f'{scope_key}_{version_key}.parquet')
+
+def save_to_cache(df, cache_path):
+    """
+    Сохранение загруженных данных в Parquet для повторных запусков
+    """
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(cache_path, compression='zstd', index=False)
+    except Exception as e:
+        # Кэш необязателен - анализ продолжается без него
+        print(f"Не удалось сохранить кэш: {e}")
+        return
+    
+    # Старые версии кэша того же запроса больше не используются
+    cache_name = os.path.basename(cache_path)
+    scope_prefix = cache_name.split('_')[0] + '_'
+    for name in os.listdir(CACHE_DIR):
+        if name.startswith(scope_prefix) and name.endswith('.parquet') and name != cache_name:
+            try:
+                os.remove(os.path.join(CACHE_DIR, name))
+            except OSError:
+                pass
+
 def get_advertising_data(db_name, ad_table, start_date, end_date):
     """
     Получение данных рекламы из базы данных
@@ -26,19 +163,63 @@ def get_advertising_data(db_name, ad_table, start_date, end_date):
     
     try:
         conn = sqlite3.connect(db_name)
+        ensure_date_index(conn, ad_table)
         
+        # Ключ кэша считаем после создания индекса, иначе он изменит дату модификации базы
+        cache_path = get_cache_path(db_name, ad_table, start_date, end_date)
+        if os.path.exists(cache_path):
+            conn.close()
+            df = pd.read_parquet(cache_path, memory_map=True)
+            print(f"Загружено {len(df)} записей (из кэша {cache_path})")
+            return df
+        
+        # Берем только колонки, которые нужны для анализа
+        table_columns = [row[1] for row in conn.execute(f"PRAGMA table_info({ad_table})")]
+        wanted_columns = DATA_COLUMNS + OPTIONAL_COLUMNS
+        # Порядок колонок таблицы сохраняется - в нем они выводятся на лист "Данные"
+        columns = [col for col in table_columns if col in wanted_columns]
+        select_columns = ', '.join(columns) if columns else '*'
+        
+        # Сравнение ISO-дат как строк использует индекс; верхняя граница
+        # не включается, чтобы захватить все записи за последний день
+        end_exclusive = (datetime.strptime(end_date, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        params = (start_date, end_exclusive)
+        where = "WHERE date >= ? AND date < ?"
+        
+        # Размер результата известен заранее - буферы выделяются один раз
+        n_rows = conn.execute(f"SELECT COUNT(*) FROM {ad_table} {where}", params).fetchone()[0]
+        # Фильтр идет по индексу даты, поэтому явно восстанавливаем порядок вставки:
+        # от него зависит выбор первых строк при равных значениях (nsmallest и т.п.)
         query = f"""
-        SELECT * FROM {ad_table} 
-        WHERE strftime('%Y-%m-%d', date) BETWEEN ? AND ?
+        SELECT {select_columns} FROM {ad_table} 
+        {where}
+        ORDER BY rowid
         """
         
-        df = pd.read_sql_query(query, conn, params=(start_date, end_date))
+        df = fetch_columns(conn, query, params, n_rows)
         conn.close()
         
+        if 'date' in df.columns:
+            # Некорректная дата в одной записи не должна прерывать загрузку
+            df['date'] = pd.to_datetime(df['date'], format='ISO8601', errors='coerce')
+        
+        # Текст в числовой колонке (например, 'n/a') оставляет ее типа object:
+        # анализ все равно приводит такие значения к NaN, а Parquet не пишет смешанные типы
+        for col in COLUMN_DTYPES:
+            if col in df.columns and df[col].dtype == object:
+                df[col] = pd.to_numeric(df[col], errors='coerce')
+        
+        # Ключи группировки с небольшим числом уникальных значений храним как category:
+        # группировка идет по целочисленным кодам, а не по строкам
+        for col in ('norm_query', 'advert_id'):
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        
         if df.empty:
             print("Нет данных рекламы для указанного периода")
             return pd.DataFrame()
         
+        save_to_cache(df, cache_path)
         print(f"Загружено {len(df)} записей")
         return df
         
@@ -49,6 +230,91 @@ def get_advertising_data(db_name, ad_table, start_date, end_date):
         print(f"Общая ошибка: {e}")
         return pd.DataFrame()
 
+def pearson_kernel(x, y):
+    """
+    Коэффициент корреляции Пирсона и p-значение (двусторонний t-тест)
+    """
+    from scipy import special
+    
+    n = len(x)
+    if n < 2:
+        # Как scipy.stats.pearsonr: вызывающий код обрабатывает ошибку
+        raise ValueError("`x` and `y` must have length at least 2.")
+    
+    dx = x - x.mean()
+    dy = y - y.mean()
+    # Скалярные произведения считаются BLAS без промежуточных массивов
+    r = np.dot(dx, dy) / np.sqrt(np.dot(dx, dx) * np.dot(dy, dy))
+    r = float(np.clip(r, -1.0, 1.0))
+
+    if np.isnan(r):
+        return r, np.nan
+    if n == 2:
+        # Через две точки прямая проходит всегда - корреляция незначима
+        return r, 1.0
+    if abs(r) == 1.0:
+        return r, 0.0
+
+    t = r * np.sqrt((n - 2) / (1.0 - r * r))
+    p = 2 * special.stdtr(n - 2, -abs(t))
+    return r, float(p)
+
+def spearman_kernel(x, y):
+    """
+    Коэффициент корреляции Спирмена: Пирсон по рангам
+    """
+    from scipy import stats
+    
+    return pearson_kernel(stats.rankdata(x), stats.rankdata(y))
+
+def correlation_matrix(df, columns):
+    """
+    Матрица корреляций Пирсона одним матричным умножением стандартизованных колонок
+    """
+    X = df[columns].to_numpy(dtype=np.float32, copy=True)
+    if np.isnan(X).any():
+        # Пропуски требуют попарного исключения - это умеет только pandas
+        return df[columns].corr()
+    
+    X -= X.mean(axis=0)
+    X /= X.std(axis=0, ddof=0)
+    C = (X.T @ X) / X.shape[0]
+    return pd.DataFrame(C, index=columns, columns=columns)
+
+def smallest_indices(values, k):
+    """
+    Индексы k наименьших значений по возрастанию за O(N), без полной сортировки.
+    При равенстве значений берутся первые по порядку, как в DataFrame.nsmallest
+    """
+    k = min(k, len(values))
+    if k == 0:
+        return np.array([], dtype=np.intp)
+    
+    kth = np.partition(values, k - 1)[k - 1]
+    below = np.flatnonzero(values < kth)
+    ties = np.flatnonzero(values == kth)[:k - len(below)]
+    idx = np.concatenate([below, ties])
+    return idx[np.argsort(values[idx], kind='stable')]
+
+def shorten_text(values, max_len):
+    """
+    Обрезка строк колонки до max_len символов с многоточием
+    """
+    text = values.astype(str)
+    return np.where(text.str.len() > max_len, text.str.slice(0, max_len) + "...", text)
+
+def interpret_correlation(corr_value):
+    """
+    Текстовое описание силы корреляции; работает и для массива значений
+    """
+    abs_corr = np.abs(corr_value)
+    idx = np.searchsorted(CORR_THRESHOLDS, abs_corr, side='right')
+    # NaN (например, при постоянном числе заказов) searchsorted ставит после всех границ
+    idx = np.where(np.isfinite(abs_corr), idx, 0)
+    if np.ndim(idx) == 0:
+        return CORR_LABELS[int(idx)]
+    return np.asarray(CORR_LABELS)[idx]
+
 def analyze_position_orders_correlation(df):
     """
     Анализ корреляции между средней позицией и количеством заказов
@@ -70,30 +336,35 @@ def analyze_position_orders_correlation(df):
     print("="*60)
     
     # 1. Предварительная обработка данных
-    df_clean = df.copy()
-    
-    # Убираем строки с NaN в ключевых колонках
-    df_clean = df_clean.dropna(subset=['avg_pos', 'orders'])
-    
-    # Преобразуем типы данных
-    df_clean['avg_pos'] = pd.to_numeric(df_clean['avg_pos'], errors='coerce')
-    df_clean['orders'] = pd.to_numeric(df_clean['orders'], errors='coerce')
+    # Приводим ключевые колонки к числам (нечисловые значения становятся NaN)
+    pos_col = pd.to_numeric(df['avg_pos'], errors='coerce')
+    ord_col = pd.to_numeric(df['orders'], errors='coerce')
+    pos = pos_col.to_numpy(dtype=np.float64, na_value=np.nan)
+    ords = ord_col.to_numpy(dtype=np.float64, na_value=np.nan)
+    
+    # Все условия очистки считаются одним проходом по массивам:
+    # NaN в ключевых колонках, нулевые заказы, выбросы позиции
+    # (больше 200 - выбросы, позиции должны быть положительными)
+    valid = np.isfinite(pos) & np.isfinite(ords)
+    has_orders = valid & (ords > 0)
+    mask = has_orders & (pos > 0) & (pos <= 200)
     
     # УБИРАЕМ ЗАКАЗЫ РАВНЫЕ НУЛЮ - ОЧИСТКА ДАННЫХ
-    original_count = len(df_clean)
-    df_clean = df_clean[df_clean['orders'] > 0]
-    removed_zero_orders = original_count - len(df_clean)
+    orders_count = int(has_orders.sum())
+    removed_zero_orders = int(valid.sum()) - orders_count
     
     print(f"Удалено записей с 0 заказами: {removed_zero_orders}")
-    print(f"Осталось записей для анализа: {len(df_clean)}")
+    print(f"Осталось записей для анализа: {orders_count}")
     
-    if len(df_clean) < 10:
+    if orders_count < 10:
         print("⚠️  Слишком мало данных для анализа после очистки")
         return None
     
-    # Убираем выбросы в позиции (слишком большие значения)
-    df_clean = df_clean[df_clean['avg_pos'] <= 200]  # Позиции больше 200 считаем выбросами
-    df_clean = df_clean[df_clean['avg_pos'] > 0]  # Позиции должны быть положительными
+    df_clean = df.loc[mask]
+    if pos_col.dtype != df['avg_pos'].dtype or ord_col.dtype != df['orders'].dtype:
+        df_clean = df_clean.assign(avg_pos=pos_col[mask], orders=ord_col[mask])
+    pos = pos[mask]
+    ords = ords[mask]
     
     print(f"Анализируем {len(df_clean)} записей после очистки")
     
@@ -110,16 +381,39 @@ def analyze_position_orders_correlation(df):
     # 3. Группировка по позициям
     print("\n📈 АНАЛИЗ ПО ГРУППАМ ПОЗИЦИЙ:")
     
-    # Создаем группы позиций
-    bins = [0, 10, 20, 30, 50, 100, 200]
-    labels = ['Топ-10', '11-20', '21-30', '31-50', '51-100', '100+']
-    
-    df_clean['position_group'] = pd.cut(df_clean['avg_pos'], bins=bins, labels=labels, right=False)
-    
-    group_stats = df_clean.groupby('position_group').agg({
-        'orders': ['count', 'mean', 'sum', 'median'],
-        'avg_pos': 'mean'
-    }).round(2)
+    # Создаем группы позиций: номер группы храним как int8,
+    # -1 - позиция вне интервалов (ровно 200)
+    n_groups = len(POSITION_LABELS)
+    gid = np.searchsorted(POSITION_BINS, pos, side='right') - 1
+    gid[gid >= n_groups] = -1
+    df_clean['position_group'] = gid.astype(np.int8)
+    
+    # Сортируем записи по номеру группы (для int8 устойчивая сортировка поразрядная, O(N)):
+    # каждая группа становится непрерывным срезом, все статистики считаются по срезам
+    in_group = gid >= 0
+    group_ids = df_clean['position_group'].to_numpy()[in_group]
+    order = np.argsort(group_ids, kind='stable')
+    sorted_orders = ords[in_group][order]
+    sorted_pos = pos[in_group][order]
+    bounds = np.searchsorted(group_ids[order], np.arange(n_groups + 1))
+    slices = [slice(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+    
+    counts = np.diff(bounds)
+    order_sums = np.array([sorted_orders[sl].sum() for sl in slices])
+    pos_sums = np.array([sorted_pos[sl].sum() for sl in slices])
+    medians = [np.median(sorted_orders[sl]) if counts[k] else np.nan
+               for k, sl in enumerate(slices)]
+    if pd.api.types.is_integer_dtype(df_clean['orders']):
+        order_sums = np.rint(order_sums).astype(np.int64)
+    
+    group_stats = pd.DataFrame({
+        ('orders', 'count'): counts,
+        ('orders', 'mean'): order_sums / np.maximum(counts, 1),
+        ('orders', 'sum'): order_sums,
+        ('orders', 'median'): medians,
+        ('avg_pos', 'mean'): pos_sums / np.maximum(counts, 1),
+    }, index=pd.Index(POSITION_LABELS, name='position_group'))
+    group_stats = group_stats[counts > 0].round(2)
     
     print(group_stats)
     
@@ -128,8 +422,8 @@ def analyze_position_orders_correlation(df):
     
     try:
         # Разные типы корреляции
-        pearson_corr, pearson_p = stats.pearsonr(df_clean['avg_pos'], df_clean['orders'])
-        spearman_corr, spearman_p = stats.spearmanr(df_clean['avg_pos'], df_clean['orders'])
+        pearson_corr, pearson_p = pearson_kernel(pos, ords)
+        spearman_corr, spearman_p = spearman_kernel(pos, ords)
         
         print(f"Коэффициент корреляции Пирсона: {pearson_corr:.4f}")
         print(f"p-значение Пирсона: {pearson_p:.6f}")
@@ -145,17 +439,6 @@ def analyze_position_orders_correlation(df):
     # Интерпретация корреляции
     print("\n📋 ИНТЕРПРЕТАЦИЯ КОРРЕЛЯЦИИ:")
     
-    def interpret_correlation(corr_value):
-        abs_corr = abs(corr_value)
-        if abs_corr >= 0.7:
-            return "сильная"
-        elif abs_corr >= 0.3:
-            return "умеренная"
-        elif abs_corr >= 0.1:
-            return "слабая"
-        else:
-            return "очень слабая или отсутствует"
-    
     direction = "отрицательная" if pearson_corr < 0 else "положительная"
     strength = interpret_correlation(abs(pearson_corr))
     
@@ -170,46 +453,68 @@ def analyze_position_orders_correlation(df):
     # 5. Анализ по отдельным кампаниям/артикулам
     print("\n🎯 АНАЛИЗ ПО ОТДЕЛЬНЫМ КАМПАНИЯМ:")
     
-    # Берем топ-10 кампаний по количеству дней показов или заказов
+    # Берем топ-10 кампаний по количеству заказов: сначала суммы заказов по всем
+    # парам (кампания, запрос), тяжелые агрегаты - только для 10 лучших.
+    # Группы идут в порядке сортировки ключей, поэтому при равных суммах выбор
+    # совпадает с nlargest по сгруппированным данным
+    has_key = (df_clean['advert_id'].notna() & df_clean['norm_query'].notna()).to_numpy()
+    keyed = df_clean[has_key]
+    campaign_groups = keyed.groupby(['advert_id', 'norm_query'], observed=True, sort=True)
+    campaign_orders = campaign_groups['orders'].sum()
+    campaign_codes = campaign_groups.ngroup().to_numpy()
+    top_codes = smallest_indices(-campaign_orders.to_numpy(dtype=np.float64), 10)
+    
+    agg_spec = {'avg_pos': 'mean', 'orders': 'sum'}
     if 'date' in df_clean.columns:
-        top_campaigns = df_clean.groupby(['advert_id', 'norm_query']).agg({
-            'date': 'nunique',
-            'avg_pos': 'mean',
-            'orders': 'sum'
-        }).nlargest(10, 'orders').reset_index()  # Используем orders для сортировки
-        sort_by = "заказам"
-    else:
-        top_campaigns = df_clean.groupby(['advert_id', 'norm_query']).agg({
-            'avg_pos': 'mean',
-            'orders': 'sum'
-        }).nlargest(10, 'orders').reset_index()
-        sort_by = "заказам"
+        agg_spec = {'date': 'nunique', **agg_spec}
+    in_top = np.isin(campaign_codes, top_codes)
+    top_stats = keyed[in_top].groupby(campaign_codes[in_top]).agg(agg_spec).reindex(top_codes)
+    
+    top_keys = campaign_orders.index[top_codes]
+    top_campaigns = pd.DataFrame({
+        'advert_id': top_keys.get_level_values(0),
+        'norm_query': top_keys.get_level_values(1),
+        **{col: top_stats[col].to_numpy() for col in agg_spec},
+    })
+    sort_by = "заказам"
     
     print(f"Топ-10 кампаний по {sort_by}:")
-    for idx, row in top_campaigns.iterrows():
-        query_display = row['norm_query'][:30] + "..." if len(str(row['norm_query'])) > 30 else row['norm_query']
-        print(f"  {idx+1}. Кампания {row['advert_id']} ({query_display}): "
-              f"Позиция={row['avg_pos']:.1f}, Заказы={row['orders']}")
+    lines = []
+    query_displays = shorten_text(top_campaigns['norm_query'], 30)
+    for i, (row, query_display) in enumerate(zip(top_campaigns.itertuples(index=False), query_displays), start=1):
+        lines.append(f"  {i}. Кампания {row.advert_id} ({query_display}): "
+                     f"Позиция={row.avg_pos:.1f}, Заказы={row.orders}")
+    if lines:
+        print("\n".join(lines))
     
     # 6. Анализ лучших и худших позиций
     print("\n🏆 АНАЛИЗ ЛУЧШИХ И ХУДШИХ ПОЗИЦИЙ:")
     
     # Лучшие позиции (топ-5 по заказам)
-    best_positions = df_clean.nsmallest(20, 'avg_pos').nlargest(5, 'orders')
+    best_pos_idx = smallest_indices(pos, 20)
+    best_pos_idx = best_pos_idx[smallest_indices(-ords[best_pos_idx], 5)]
+    best_positions = df_clean.iloc[best_pos_idx]
     print("Лучшие комбинации позиция/заказы (низкая позиция + много заказов):")
-    for idx, row in best_positions.iterrows():
-        query_display = str(row['norm_query'])[:20] + "..." if len(str(row['norm_query'])) > 20 else row['norm_query']
-        print(f"  Позиция {row['avg_pos']:.1f}: {row['orders']} заказов "
-              f"({query_display})")
+    lines = []
+    query_displays = shorten_text(best_positions['norm_query'], 20)
+    for row, query_display in zip(best_positions.itertuples(index=False), query_displays):
+        lines.append(f"  Позиция {row.avg_pos:.1f}: {row.orders} заказов "
+                     f"({query_display})")
+    if lines:
+        print("\n".join(lines))
     
     # Худшие позиции (высокие позиции с малым количеством заказов)
-    high_pos_low_orders = df_clean[df_clean['avg_pos'] > 30].nsmallest(5, 'orders')
+    high_pos_idx = np.flatnonzero(pos > 30)
+    high_pos_idx = high_pos_idx[smallest_indices(ords[high_pos_idx], 5)]
+    high_pos_low_orders = df_clean.iloc[high_pos_idx]
     if len(high_pos_low_orders) > 0:
         print("\n❌ Худшие комбинации (высокая позиция + мало заказов):")
-        for idx, row in high_pos_low_orders.iterrows():
-            query_display = str(row['norm_query'])[:20] + "..." if len(str(row['norm_query'])) > 20 else row['norm_query']
-            print(f"  Позиция {row['avg_pos']:.1f}: {row['orders']} заказов "
-                  f"({query_display})")
+        lines = []
+        query_displays = shorten_text(high_pos_low_orders['norm_query'], 20)
+        for row, query_display in zip(high_pos_low_orders.itertuples(index=False), query_displays):
+            lines.append(f"  Позиция {row.avg_pos:.1f}: {row.orders} заказов "
+                         f"({query_display})")
+        print("\n".join(lines))
     
     # 7. Рекомендации
     print("\n💡 РЕКОМЕНДАЦИИ НА ОСНОВЕ АНАЛИЗА:")
@@ -235,15 +540,18 @@ def analyze_position_orders_correlation(df):
         print(f"   Поддерживайте текущие результаты")
     
     # Анализ эффективности разных групп позиций
-    if 'position_group' in df_clean.columns:
-        top10_data = df_clean[df_clean['position_group'] == 'Топ-10']
-        if not top10_data.empty:
-            top10_efficiency = top10_data['orders'].sum() / len(top10_data)
-            other_efficiency = df_clean[df_clean['position_group'] != 'Топ-10']['orders'].sum() / len(df_clean[df_clean['position_group'] != 'Топ-10'])
-            
-            if top10_efficiency > other_efficiency * 1.5:
-                print(f"6. ⭐ Товары в топ-10 приносят в {top10_efficiency/other_efficiency:.1f} раз больше заказов на запись")
-                print(f"   Увеличивайте бюджет на топовые позиции")
+    # Маска группы "Топ-10" (код 0) считается один раз, дальше - только скаляры
+    is_top10 = gid == 0
+    top10_count = int(is_top10.sum())
+    other_count = len(gid) - top10_count
+    if top10_count and other_count:
+        top10_orders = ords[is_top10].sum()
+        top10_efficiency = top10_orders / top10_count
+        other_efficiency = (ords.sum() - top10_orders) / other_count
+        
+        if top10_efficiency > other_efficiency * 1.5:
+            print(f"6. ⭐ Товары в топ-10 приносят в {top10_efficiency/other_efficiency:.1f} раз больше заказов на запись")
+            print(f"   Увеличивайте бюджет на топовые позиции")
     
     # 8. Визуализация
     create_visualizations(df_clean, pearson_corr)
@@ -262,7 +570,18 @@ def create_visualizations(df, correlation):
     """
     Создание визуализаций для анализа
     """
-    plt.style.use('seaborn-v0_8')
+    # matplotlib загружается только при построении графиков
+    import matplotlib
+    if HEADLESS:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    
+    plt.rcParams.update(PLOT_STYLE)
+    
+    # Массивы позиций и заказов считаются один раз и используются всеми графиками
+    positions = df['avg_pos'].to_numpy(dtype=np.float64)
+    orders = df['orders'].to_numpy(dtype=np.float64)
+    
     fig, axes = plt.subplots(2, 3, figsize=(18, 12))
     fig.suptitle(f'Анализ корреляции позиции и заказов (корреляция: {correlation:.3f})', 
                 fontsize=16, fontweight='bold')
@@ -277,16 +596,21 @@ def create_visualizations(df, correlation):
     
     # Линия тренда
     if len(df) > 1:
-        try:
-            z = np.polyfit(df['avg_pos'], df['orders'], 1)
-            p = np.poly1d(z)
-            ax1.plot(df['avg_pos'], p(df['avg_pos']), "r--", alpha=0.8, linewidth=2)
-        except:
-            pass
+        # Линейная регрессия в замкнутом виде: slope = cov(x, y) / var(x)
+        x, y = positions, orders
+        dx = x - x.mean()
+        var_x = np.dot(dx, dx)
+        if var_x > 0:
+            slope = np.dot(dx, y - y.mean()) / var_x
+            intercept = y.mean() - slope * x.mean()
+            x_line = np.array([x.min(), x.max()])
+            ax1.plot(x_line, slope * x_line + intercept, "r--", alpha=0.8, linewidth=2)
     
     # 2. Распределение позиций
     ax2 = axes[0, 1]
-    ax2.hist(df['avg_pos'], bins=30, edgecolor='black', alpha=0.7, color='skyblue')
+    hist_pos, edges_pos = np.histogram(df['avg_pos'].to_numpy(), bins=30)
+    ax2.bar(edges_pos[:-1], hist_pos, width=np.diff(edges_pos), align='edge',
+            edgecolor='black', alpha=0.7, color='skyblue')
     ax2.set_xlabel('Средняя позиция')
     ax2.set_ylabel('Частота')
     ax2.set_title('Распределение позиций')
@@ -296,7 +620,9 @@ def create_visualizations(df, correlation):
     ax3 = axes[0, 2]
     # Логарифмическая шкала для лучшей визуализации
     orders_log = np.log1p(df['orders'])
-    ax3.hist(orders_log, bins=30, edgecolor='black', alpha=0.7, color='lightgreen')
+    hist_orders, edges_orders = np.histogram(orders_log, bins=30)
+    ax3.bar(edges_orders[:-1], hist_orders, width=np.diff(edges_orders), align='edge',
+            edgecolor='black', alpha=0.7, color='lightgreen')
     ax3.set_xlabel('log(Заказы + 1)')
     ax3.set_ylabel('Частота')
     ax3.set_title('Распределение заказов (логарифм)')
@@ -305,14 +631,20 @@ def create_visualizations(df, correlation):
     # 4. Средние заказы по группам позиций
     ax4 = axes[1, 0]
     if 'position_group' in df.columns:
-        group_means = df.groupby('position_group')['orders'].mean()
-        group_counts = df.groupby('position_group').size()
+        # Статистика по группам считается один раз и используется в графиках 4 и 5
+        # (номер группы -1 - позиция вне интервалов)
+        group_codes = df['position_group'].to_numpy()
+        group_orders = orders
+        in_group = group_codes >= 0
+        group_counts = np.bincount(group_codes[in_group], minlength=len(POSITION_LABELS))
+        group_sums = np.bincount(group_codes[in_group], weights=group_orders[in_group],
+                                 minlength=len(POSITION_LABELS))
         
         # Создаем DataFrame для сортировки
         group_data = pd.DataFrame({
-            'mean_orders': group_means,
+            'mean_orders': group_sums / np.maximum(group_counts, 1),
             'count': group_counts
-        }).dropna()
+        }, index=POSITION_LABELS)[group_counts > 0]
         
         if not group_data.empty:
             # Сортируем по количеству записей
@@ -338,12 +670,12 @@ def create_visualizations(df, correlation):
     ax5 = axes[1, 1]
     if 'position_group' in df.columns:
         # Используем группы с достаточным количеством данных
-        valid_groups = df['position_group'].value_counts()
-        valid_groups = valid_groups[valid_groups >= 5].index.tolist()
+        valid_groups = [k for k in np.argsort(-group_counts, kind='stable') if group_counts[k] >= 5]
         
         if len(valid_groups) >= 2:
-            data_to_plot = [df[df['position_group'] == group]['orders'] for group in valid_groups[:4]]
-            box = ax5.boxplot(data_to_plot, labels=valid_groups[:4], patch_artist=True)
+            data_to_plot = [group_orders[group_codes == k] for k in valid_groups[:4]]
+            box = ax5.boxplot(data_to_plot, labels=[POSITION_LABELS[k] for k in valid_groups[:4]],
+                              patch_artist=True)
             
             # Цвета для box plot
             colors = ['lightblue', 'lightgreen', 'lightcoral', 'lightsalmon']
@@ -371,7 +703,7 @@ def create_visualizations(df, correlation):
     
     if len(numeric_cols) > 2:
         try:
-            corr_matrix = df[numeric_cols].corr()
+            corr_matrix = correlation_matrix(df, numeric_cols)
             im = ax6.imshow(corr_matrix, cmap='coolwarm', vmin=-1, vmax=1)
             ax6.set_xticks(range(len(numeric_cols)))
             ax6.set_yticks(range(len(numeric_cols)))
@@ -410,17 +742,31 @@ def create_visualizations(df, correlation):
     filename = f'position_orders_correlation_{START_DATE}_to_{END_DATE}.png'
     plt.savefig(filename, dpi=150, bbox_inches='tight')
     print(f"\n📊 Графики сохранены в файл: {filename}")
+    if HEADLESS:
+        # Показывать фигуру не нужно - сразу освобождаем ее буферы
+        plt.close(fig)
     
     # Создаем дополнительный график: тренд заказов по позициям
-    plt.figure(figsize=(10, 6))
-    
-    # Группируем по позициям (округляем для группировки)
-    df['pos_rounded'] = df['avg_pos'].round()
-    trend_data = df.groupby('pos_rounded').agg({
-        'orders': ['mean', 'count', 'std']
-    }).reset_index()
-    
-    trend_data.columns = ['position', 'avg_orders', 'count', 'std_orders']
+    trend_fig = plt.figure(figsize=(10, 6))
+    
+    # Группируем по позициям (округляем для группировки): количество, сумма и сумма
+    # квадратов заказов по каждой округленной позиции за один проход bincount
+    rounded = np.rint(positions).astype(np.int32)
+    pos_counts = np.bincount(rounded)
+    pos_sums = np.bincount(rounded, weights=orders)
+    pos_sq_sums = np.bincount(rounded, weights=orders * orders)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_orders = pos_sums / pos_counts
+        # Выборочное стандартное отклонение (ddof=1), как в pandas
+        std_orders = np.sqrt(np.maximum(pos_sq_sums - pos_sums * avg_orders, 0) / (pos_counts - 1))
+    
+    trend_data = pd.DataFrame({
+        'position': np.arange(len(pos_counts), dtype=np.float64),
+        'avg_orders': avg_orders,
+        'count': pos_counts,
+        'std_orders': std_orders,
+    })
     
     # Фильтруем позиции с достаточным количеством данных
     trend_data = trend_data[trend_data['count'] >= 3]
@@ -444,7 +790,12 @@ def create_visualizations(df, correlation):
     else:
         print("⚠️  Недостаточно данных для создания графика тренда")
     
-    plt.show()
+    if not HEADLESS:
+        plt.show()
+    
+    # Закрываем фигуры, чтобы повторные вызовы (например, в цикле по параметрам) не копили память
+    plt.close(fig)
+    plt.close(trend_fig)
 
 def save_results_to_excel(results, filename=None):
     """
@@ -457,10 +808,21 @@ def save_results_to_excel(results, filename=None):
     if filename is None:
         filename = f'position_orders_analysis_{START_DATE}_to_{END_DATE}.xlsx'
     
+    # В выгрузке группы позиций показываем подписями, а не внутренними кодами
+    export_data = results['data']
+    if 'position_group' in export_data.columns:
+        export_data = export_data.assign(position_group=pd.Categorical.from_codes(
+            export_data['position_group'].to_numpy(), categories=POSITION_LABELS))
+    
     try:
-        with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-            # Основные данные
-            results['data'].to_excel(writer, sheet_name='Данные', index=False)
+        with pd.ExcelWriter(filename, engine='xlsxwriter') as writer:
+            # Основные данные (большие объемы - в CSV, чтобы не держать их в книге)
+            if len(export_data) > EXCEL_MAX_DATA_ROWS:
+                data_filename = os.path.splitext(filename)[0] + '_data.csv'
+                export_data.to_csv(data_filename, index=False)
+                print(f"💾 Данные ({len(export_data)} записей) сохранены в CSV файл: {data_filename}")
+            else:
+                export_data.to_excel(writer, sheet_name='Данные', index=False)
             
             # Статистика по группам
             results['group_stats'].to_excel(writer, sheet_name='Групповая статистика')
@@ -500,11 +862,15 @@ def save_results_to_excel(results, filename=None):
             summary_df.to_excel(writer, sheet_name='Сводка', index=False)
             
             # Дополнительный анализ: топ-20 записей по заказам
-            top_20_by_orders = results['data'].nlargest(20, 'orders')[['norm_query', 'advert_id', 'nm_id', 'avg_pos', 'orders']]
+            # (отбор по массивам за O(N), в DataFrame попадают только 20 строк)
+            top_columns = ['norm_query', 'advert_id', 'nm_id', 'avg_pos', 'orders']
+            orders_arr = results['data']['orders'].to_numpy(dtype=np.float64)
+            top_20_by_orders = results['data'].iloc[smallest_indices(-orders_arr, 20)][top_columns]
             top_20_by_orders.to_excel(writer, sheet_name='Топ-20 по заказам', index=False)
             
             # Дополнительный анализ: топ-20 лучших позиций
-            top_20_by_position = results['data'].nsmallest(20, 'avg_pos')[['norm_query', 'advert_id', 'nm_id', 'avg_pos', 'orders']]
+            pos_arr = results['data']['avg_pos'].to_numpy(dtype=np.float64)
+            top_20_by_position = results['data'].iloc[smallest_indices(pos_arr, 20)][top_columns]
             top_20_by_position.to_excel(writer, sheet_name='Топ-20 позиций', index=False)
         
         print(f"\n💾 Результаты сохранены в Excel файл: {filename}")